@@ -16,6 +16,7 @@ from flask import Flask
 from flask import Response
 from flask import request
 from flask_basicauth import BasicAuth
+import hostpool
 import json
 import os
 import re
@@ -36,6 +37,11 @@ basic_auth = BasicAuth(app)
 
 BACKGROUND_WORK_INTERVAL_SECONDS = 300
 
+# Where the dynamic services run:
+#   cloudrun - Google Cloud Run, via gcloud (the default)
+#   hosts    - our own pool of container hosts, see hostpool.py
+SERVICE_BACKEND = os.environ.get('SERVICE_BACKEND', 'cloudrun')
+
 # Use this as a prefix when creating any dynamic services.
 # Allows us to easily stop them after a given time period.
 DYN_SERVICE_PREFIX = "dyn-svc-"
@@ -61,6 +67,15 @@ SERVICES = {}
 # This will be replaced by the dynamically-generated service name
 SERVICES['order-up'] = 'order-up-gcloud-service.yaml'
 
+if SERVICE_BACKEND == 'hosts':
+    # The same YAML files are used to learn what each challenge needs.
+    # The placeholders are irrelevant there.
+    appDir = os.path.split(__file__)[0]
+    hostsFile = os.environ.get('CONTAINER_HOSTS_FILE', appDir + '/container-hosts.json')
+    hostpool.setup(hostsFile, SERVICES, appDir, DYN_SERVICE_MAX_LIFETIME_SECONDS)
+elif SERVICE_BACKEND != 'cloudrun':
+    raise ValueError('unknown SERVICE_BACKEND: ' + SERVICE_BACKEND)
+
 
 @app.route('/')
 def root():
@@ -190,7 +205,10 @@ def getServiceInfo(serviceName):
     if error:
         return {"message": error}, 400
 
-    serviceUrl, secondsToLive = findServiceInstance(uniqueServiceName)
+    if SERVICE_BACKEND == 'hosts':
+        serviceUrl, secondsToLive = hostpool.findServiceInstance(uniqueServiceName)
+    else:
+        serviceUrl, secondsToLive = findServiceInstance(uniqueServiceName)
     if serviceUrl:
         message = "service instance is running"
         serviceInstanceRunning = True
@@ -213,6 +231,15 @@ def startServiceIntance(serviceName):
     if error:
         return {"message": error}, 400
 
+    if SERVICE_BACKEND == 'hosts':
+        instance, error = hostpool.startServiceInstance(serviceName, uniqueServiceName)
+        if error:
+            return {"message": error}, 500
+
+        # the lifetime started counting before the containers came up
+        response = {"message": "service started", "serviceUrl": hostpool.getServiceUrl(instance), "secondsToLive": hostpool.getSecondsToLive(instance)}
+        return response, 200
+
     # If the service doesn't exist, this will fail (and we don't care).
     region = getRegionFromServiceName(uniqueServiceName)
     cmd = f'gcloud run services delete {uniqueServiceName} -q --region={region}'
@@ -293,7 +320,10 @@ def pruneOldDynamicServices():
 
 
 def doPeriodicWork():
-    pruneOldDynamicServices()
+    if SERVICE_BACKEND == 'hosts':
+        hostpool.pruneOldDynamicServices()
+    else:
+        pruneOldDynamicServices()
 
 
 def periodicWorkLoop():
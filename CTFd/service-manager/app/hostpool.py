@@ -0,0 +1,495 @@
+# The "hosts" backend: runs dynamic services on our own container hosts
+# instead of Cloud Run.  Useful for events on our own hardware where the
+# Cloud Run cold starts and quota limits (see the top of app.py) don't apply.
+#
+# Every host in the pool runs ../host-agent/agent.py which does the actual
+# docker work.  This module only decides WHAT runs WHERE:
+#
+# - the same catalog YAML files used for Cloud Run are read to find the
+#   containers, their cpu/memory limits, ports, startup probes and
+#   container dependencies
+# - instances are bin-packed onto the hosts by cpu and memory
+# - each instance gets one public port from its host's port range
+#
+# All the bookkeeping is kept in memory so picking a host is a quick walk
+# over a few dicts.  The agents are the source of truth though: the periodic
+# prune re-reads what every host is actually running, so a restarted service
+# manager adopts the instances started by its previous run.
+
+import json
+import os
+import requests
+import threading
+import time
+import yaml
+
+AGENT_USERNAME = 'private'
+AGENT_TIMEOUT_SECONDS = 30
+
+# Kept short so a host that is powered off only costs a POST a few seconds,
+# the timeouts above and below are for how long the agent may take to answer.
+AGENT_CONNECT_TIMEOUT_SECONDS = 3
+
+# Starting an instance includes pulling its images (first time only on a
+# host) on top of waiting for the startup probes.  The whole start gets this
+# plus the largest probe budget of its containers, not the sum of them all,
+# so a POST to /service can't hang around for many minutes.
+IMAGE_PULL_ALLOWANCE_SECONDS = 120
+
+# ...and never longer than a Cloud Run request may take, which is what the
+# service manager itself runs behind when it is deployed to gcloud.
+MAX_START_TIMEOUT_SECONDS = 300
+
+# Used when a catalog container has no startupProbe, same as Cloud Run's
+# default tcp probe (periodSeconds=240, failureThreshold=1).
+DEFAULT_PROBE_BUDGET_SECONDS = 240
+
+# syntax of the hosts file (a JSON list, one entry per container host):
+#
+# [
+#     {
+#         "name": "node1",
+#         "agentUrl": "http://10.0.0.11:7000",
+#         "publicHost": "node1.ctf.example.org",
+#         "cpu": 16000,               <- millicores available for challenges
+#         "memory": 65536,            <- MiB available for challenges
+#         "ports": [20000, 20999]     <- first and last public port to hand out
+#     }
+# ]
+HOSTS = []
+
+# SERVICE_SPECS[<challenge-name>] = what it takes to run one instance of it
+SERVICE_SPECS = {}
+
+# INSTANCES[<unique-service-name>] = where that instance runs
+INSTANCES = {}
+
+# guards HOSTS usage counters and health, and INSTANCES
+LOCK = threading.Lock()
+
+AGENT_PASSWORD = None
+MAX_LIFETIME_SECONDS = None
+
+
+def setup(hostsFile, services, serviceDir, maxLifetimeSeconds):
+    global AGENT_PASSWORD
+    global MAX_LIFETIME_SECONDS
+
+    # if this env var is not defined, this will fail early and not run at all
+    AGENT_PASSWORD = os.environ['AGENT_PASSWORD']
+    MAX_LIFETIME_SECONDS = maxLifetimeSeconds
+
+    with open(hostsFile) as f:
+        for host in json.load(f):
+            firstPort, lastPort = host['ports']
+            HOSTS.append({
+                'name': host['name'],
+                'agentUrl': host['agentUrl'].rstrip('/'),
+                'publicHost': host['publicHost'],
+                'cpu': int(host['cpu']),
+                'memory': int(host['memory']),
+                'firstPort': int(firstPort),
+                'lastPort': int(lastPort),
+                'usedCpu': 0,
+                'usedMemory': 0,
+                'usedPorts': set(),
+                # Until the first prune has adopted what already runs there,
+                # we don't know which of its ports and how much room are taken.
+                'healthy': False,
+            })
+
+    for serviceName, yamlFile in services.items():
+        SERVICE_SPECS[serviceName] = loadServiceSpec(os.path.join(serviceDir, yamlFile))
+
+    print('container hosts: ', [host['name'] for host in HOSTS])
+
+
+def parseCpu(value):
+    # Kubernetes style quantity, e.g. '1000m' or '2', returned as millicores
+    value = str(value)
+    if value.endswith('m'):
+        return int(value[:-1])
+    return int(float(value) * 1000)
+
+
+MEMORY_UNITS_IN_MIB = {
+    'Ki': 1 / 1024,
+    'Mi': 1,
+    'Gi': 1024,
+    'K': 1000 / 1024 / 1024,
+    'M': 1000 * 1000 / 1024 / 1024,
+    'G': 1000 * 1000 * 1000 / 1024 / 1024,
+}
+
+def parseMemory(value):
+    # Kubernetes style quantity, e.g. '512Mi' or '1Gi', returned as MiB
+    value = str(value)
+    for unit in ['Ki', 'Mi', 'Gi', 'K', 'M', 'G']:
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * MEMORY_UNITS_IN_MIB[unit])
+    return int(int(value) / 1024 / 1024)
+
+
+def loadServiceSpec(yamlFile):
+    with open(yamlFile) as f:
+        service = yaml.safe_load(f)
+
+    template = service['spec']['template']
+    annotations = (template.get('metadata') or {}).get('annotations') or {}
+    dependencies = json.loads(annotations.get('run.googleapis.com/container-dependencies', '{}'))
+
+    spec = {
+        'containers': [],
+        'ingressContainer': None,
+        'containerPort': None,
+        'cpu': 0,
+        'memory': 0,
+        'startTimeoutSeconds': IMAGE_PULL_ALLOWANCE_SECONDS,
+    }
+
+    for container in template['spec']['containers']:
+        limits = (container.get('resources') or {}).get('limits') or {}
+        probe = container.get('startupProbe') or {}
+        probePort = (probe.get('tcpSocket') or {}).get('port')
+        probeBudgetSeconds = DEFAULT_PROBE_BUDGET_SECONDS
+        if probe:
+            probeBudgetSeconds = probe.get('periodSeconds', 10) * probe.get('failureThreshold', 3)
+
+        cpu = parseCpu(limits.get('cpu', '1000m'))
+        memory = parseMemory(limits.get('memory', '512Mi'))
+
+        ports = container.get('ports')
+        if ports:
+            # Cloud Run only allows one container to receive requests
+            spec['ingressContainer'] = container['name']
+            spec['containerPort'] = ports[0]['containerPort']
+            if not probePort:
+                probePort = spec['containerPort']
+
+        spec['containers'].append({
+            'name': container['name'],
+            'image': container['image'],
+            'env': {env['name']: str(env.get('value', '')) for env in container.get('env') or []},
+            'cpu': cpu,
+            'memory': memory,
+            'probePort': probePort,
+            'probeBudgetSeconds': probeBudgetSeconds,
+            'dependsOn': dependencies.get(container['name'], []),
+        })
+        spec['cpu'] += cpu
+        spec['memory'] += memory
+        spec['startTimeoutSeconds'] = max(spec['startTimeoutSeconds'], IMAGE_PULL_ALLOWANCE_SECONDS + probeBudgetSeconds)
+
+    spec['startTimeoutSeconds'] = min(spec['startTimeoutSeconds'], MAX_START_TIMEOUT_SECONDS)
+
+    if not spec['ingressContainer']:
+        raise ValueError('no container with a port defined in: ' + yamlFile)
+
+    checkContainerDependencies(spec['containers'], yamlFile)
+
+    return spec
+
+
+def checkContainerDependencies(containers, yamlFile):
+    # Catch a bad container-dependencies annotation at setup() rather than
+    # on every start.  The agent starts containers in this order.
+    dependsOn = {container['name']: container['dependsOn'] for container in containers}
+    for name, dependencies in dependsOn.items():
+        for dependency in dependencies:
+            if dependency not in dependsOn:
+                raise ValueError(f'{name} depends on unknown container {dependency} in: {yamlFile}')
+
+    done = set()
+    def visit(name, path):
+        if name in path:
+            raise ValueError('circular container dependency: ' + ' -> '.join(path + [name]) + ' in: ' + yamlFile)
+        if name in done:
+            return
+        for dependency in dependsOn[name]:
+            visit(dependency, path + [name])
+        done.add(name)
+
+    for name in dependsOn:
+        visit(name, [])
+
+
+def callAgent(host, method, path, payload=None, timeout=AGENT_TIMEOUT_SECONDS):
+    url = host['agentUrl'] + path
+    return requests.request(method, url, json=payload, auth=(AGENT_USERNAME, AGENT_PASSWORD), timeout=(AGENT_CONNECT_TIMEOUT_SECONDS, timeout))
+
+
+def getSecondsToLive(instance):
+    return int(instance['startTime'] + MAX_LIFETIME_SECONDS - time.time())
+
+
+def getServiceUrl(instance):
+    return f"http://{instance['host']['publicHost']}:{instance['port']}"
+
+
+def findFreePort(host):
+    for port in range(host['firstPort'], host['lastPort'] + 1):
+        if port not in host['usedPorts']:
+            return port
+    return None
+
+
+def pickHost(spec):
+    # Best fit: the host with the least room left over once this instance is
+    # on it.  This fills up busy hosts first, keeping big holes free for big
+    # services and letting quiet hosts drain so they can be turned off.
+    bestHost = None
+    bestLeftover = None
+    for host in HOSTS:
+        if not host['healthy']:
+            continue
+
+        freeCpu = host['cpu'] - host['usedCpu'] - spec['cpu']
+        freeMemory = host['memory'] - host['usedMemory'] - spec['memory']
+        if freeCpu < 0 or freeMemory < 0:
+            continue
+
+        # Adopted instances may hold ports outside the configured range (e.g.
+        # after the hosts file changed), so counting used ports isn't enough.
+        if findFreePort(host) is None:
+            continue
+
+        leftover = freeCpu / host['cpu'] + freeMemory / host['memory']
+        if bestLeftover is None or leftover < bestLeftover:
+            bestHost = host
+            bestLeftover = leftover
+
+    return bestHost
+
+
+# The functions below that touch HOSTS counters or INSTANCES must be called with LOCK held.
+
+def addInstance(instance):
+    host = instance['host']
+    host['usedCpu'] += instance['cpu']
+    host['usedMemory'] += instance['memory']
+    host['usedPorts'].add(instance['port'])
+    INSTANCES[instance['name']] = instance
+
+
+def removeInstance(instance):
+    # the instance may have been replaced (or already removed) by another thread
+    if INSTANCES.get(instance['name']) is not instance:
+        return
+
+    host = instance['host']
+    host['usedCpu'] -= instance['cpu']
+    host['usedMemory'] -= instance['memory']
+    host['usedPorts'].discard(instance['port'])
+    del INSTANCES[instance['name']]
+
+
+def reserveInstance(uniqueServiceName, spec, startTime):
+    host = pickHost(spec)
+    if not host:
+        return None
+
+    instance = {
+        'name': uniqueServiceName,
+        'host': host,
+        'port': findFreePort(host),
+        'cpu': spec['cpu'],
+        'memory': spec['memory'],
+        'startTime': startTime,
+        'ready': False,
+        'deleting': False,
+    }
+    addInstance(instance)
+    return instance
+
+
+def claimExpiredInstances():
+    expired = []
+    for instance in INSTANCES.values():
+        if instance['ready'] and not instance['deleting'] and getSecondsToLive(instance) <= 0:
+            instance['deleting'] = True
+            expired.append(instance)
+    return expired
+
+
+def undeployInstance(instance):
+    print('Undeploying: ', instance['name'], 'from', instance['host']['name'])
+    try:
+        response = callAgent(instance['host'], 'DELETE', '/instances/' + instance['name'])
+        print('agent: ', response.status_code, response.text)
+    except requests.RequestException as e:
+        print('Error talking to host agent: ', instance['host']['name'], e)
+
+
+def reclaimInstances(instances):
+    # The capacity is only given back once the agent is done with the
+    # containers, otherwise a new instance could be handed a port that is
+    # still in use.
+    for instance in instances:
+        undeployInstance(instance)
+        with LOCK:
+            removeInstance(instance)
+
+
+def findServiceInstance(uniqueServiceName):
+    with LOCK:
+        instance = INSTANCES.get(uniqueServiceName)
+        if not instance or not instance['ready'] or instance['deleting']:
+            return None, 0
+        return getServiceUrl(instance), getSecondsToLive(instance)
+
+
+def placeInstance(uniqueServiceName, spec):
+    with LOCK:
+        instance = reserveInstance(uniqueServiceName, spec, int(time.time()))
+        expired = [] if instance else claimExpiredInstances()
+
+    if not instance and expired:
+        # Out of room, but expired instances are still holding some until
+        # the next prune.  Take it back now rather than turning people away.
+        reclaimInstances(expired)
+        with LOCK:
+            instance = reserveInstance(uniqueServiceName, spec, int(time.time()))
+
+    return instance
+
+
+def startServiceInstance(serviceName, uniqueServiceName):
+    spec = SERVICE_SPECS[serviceName]
+
+    # Same as the Cloud Run backend: starting again replaces any existing instance.
+    with LOCK:
+        oldInstance = INSTANCES.get(uniqueServiceName)
+        if oldInstance:
+            oldInstance['deleting'] = True
+    if oldInstance:
+        reclaimInstances([oldInstance])
+
+    # A host we can't connect to is marked unhealthy, so each retry goes
+    # to another one until they run out.
+    while True:
+        instance = placeInstance(uniqueServiceName, spec)
+        if not instance:
+            return None, 'no reachable container host has room for another ' + serviceName
+
+        host = instance['host']
+        payload = {
+            'startTime': instance['startTime'],
+            'publishedPort': instance['port'],
+            'ingressContainer': spec['ingressContainer'],
+            'containerPort': spec['containerPort'],
+            'startTimeoutSeconds': spec['startTimeoutSeconds'],
+            'cpu': spec['cpu'],
+            'memory': spec['memory'],
+            'containers': spec['containers'],
+        }
+
+        print('placing', uniqueServiceName, 'on', host['name'], 'port', instance['port'])
+        try:
+            response = callAgent(host, 'PUT', '/instances/' + uniqueServiceName, payload, timeout=spec['startTimeoutSeconds'] + AGENT_TIMEOUT_SECONDS)
+            break
+        except requests.ConnectionError as e:
+            # Never got through to the agent, so there is nothing to undeploy.
+            # Leave this host alone until the next prune finds its agent again.
+            print('Host agent unreachable: ', host['name'], e)
+            with LOCK:
+                host['healthy'] = False
+                removeInstance(instance)
+        except requests.RequestException as e:
+            # on a timeout the agent may still be starting it
+            reclaimInstances([instance])
+            return None, f"host agent {host['name']} failed: {e}"
+
+    if response.status_code != 200:
+        # the agent cleans up after a failed start itself
+        with LOCK:
+            removeInstance(instance)
+        return None, 'service failed to start: ' + response.text
+
+    with LOCK:
+        # Another start for the same name may have replaced (and undeployed)
+        # this one while we waited.  Its port may belong to the new one by now.
+        replaced = INSTANCES.get(uniqueServiceName) is not instance or instance['deleting']
+        if not replaced:
+            instance['ready'] = True
+    if replaced:
+        return None, 'service was restarted by another request while starting'
+    return instance, None
+
+
+def reconcileHost(host):
+    # Starts and deletes carry on while we wait for the agent, so only judge
+    # what was already settled before asking it.
+    with LOCK:
+        knownNames = set(INSTANCES)
+        readyInstances = [instance for instance in INSTANCES.values() if instance['host'] is host and instance['ready']]
+
+    try:
+        response = callAgent(host, 'GET', '/instances')
+        response.raise_for_status()
+        reported = response.json()
+    except (requests.RequestException, ValueError) as e:
+        print('Host agent not usable, skipping host: ', host['name'], e)
+        with LOCK:
+            host['healthy'] = False
+        return
+
+    orphans = []
+    dead = []
+    with LOCK:
+        # only once its instances are adopted below can it take new ones
+        host['healthy'] = True
+        runningNames = set()
+        for item in reported:
+            name = item['name']
+            instance = INSTANCES.get(name)
+
+            if not item.get('running', True):
+                # Its containers exited (crashed, host rebooted...).  Only the
+                # leftovers are still there, see below for our own record of it.
+                if not instance and name not in knownNames:
+                    orphans.append({'name': name, 'host': host})
+                continue
+
+            runningNames.add(name)
+            if not instance and name not in knownNames:
+                # started by an earlier run of the service manager
+                addInstance({
+                    'name': name,
+                    'host': host,
+                    'port': int(item['publishedPort']),
+                    'cpu': int(item['cpu']),
+                    'memory': int(item['memory']),
+                    'startTime': int(item['startTime']),
+                    'ready': True,
+                    'deleting': False,
+                })
+            elif instance and instance['host'] is not host:
+                # it has since been started again elsewhere, this copy is unreachable
+                orphans.append({**instance, 'host': host})
+
+        for instance in readyInstances:
+            if instance['name'] not in runningNames and INSTANCES.get(instance['name']) is instance and not instance['deleting']:
+                # gone from the host or dead (crashed, host rebooted, removed by hand...)
+                instance['deleting'] = True
+                dead.append(instance)
+
+    for orphan in orphans:
+        undeployInstance(orphan)
+
+    # clear out whatever the dead ones left behind before giving their room away
+    reclaimInstances(dead)
+
+
+def pruneOldDynamicServices():
+    for host in HOSTS:
+        reconcileHost(host)
+
+    with LOCK:
+        expired = claimExpiredInstances()
+    reclaimInstances(expired)
+
+    with LOCK:
+        for host in HOSTS:
+            print(f"host {host['name']}: cpu {host['usedCpu']}/{host['cpu']}m, "
+                  f"memory {host['usedMemory']}/{host['memory']}Mi, "
+                  f"instances {len(host['usedPorts'])}")
@@ -0,0 +1,367 @@
+# Host agent for the "hosts" backend of the service manager (see app/hostpool.py).
+#
+# Run one of these on every container host listed in the service manager's
+# container-hosts.json.  The service manager decides WHAT runs WHERE, this
+# agent just does the docker work on its own machine:
+#
+#   GET    /instances          list the instances running here
+#   PUT    /instances/<name>   (re)start an instance, returns once it is ready
+#   DELETE /instances/<name>   stop and remove an instance
+#
+# Set FAKE_DOCKER=1 to run without docker.  The containers are still walked
+# in dependency order, but only the ingress one is stood in for, by a tiny web
+# server on the published port.  That is enough to try out scheduling, the
+# readiness probe, expiry and pruning on a laptop (see ../hosts-backend-check.py).
+
+from flask import Flask
+from flask import request
+from flask_basicauth import BasicAuth
+import http.server
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+app = Flask(__name__)
+
+app.config['BASIC_AUTH_USERNAME'] = 'private'
+# if this env var is not defined, this will fail early and not run at all
+app.config['BASIC_AUTH_PASSWORD'] = os.environ['AGENT_PASSWORD']
+app.config['BASIC_AUTH_FORCE'] = True
+
+basic_auth = BasicAuth(app)
+
+FAKE_DOCKER = os.environ.get('FAKE_DOCKER') == '1'
+
+PROBE_INTERVAL_SECONDS = 0.25
+
+# Holds the network namespace that all containers of one instance share.
+PAUSE_IMAGE = os.environ.get('PAUSE_IMAGE', 'registry.k8s.io/pause:3.9')
+
+# Every container we start carries these labels.  They let us find our
+# instances again and tell the service manager how much they were given.
+LABEL_INSTANCE = 'ctf.instance'
+LABEL_START_TIME = 'ctf.start-time'
+LABEL_PUBLISHED_PORT = 'ctf.published-port'
+LABEL_CPU = 'ctf.cpu'
+LABEL_MEMORY = 'ctf.memory'
+
+NO_INJECTION_REGEX = '^[a-z0-9-]+$'
+
+# INSTANCE_OPS[<instance-name>] = {'lock': ..., 'generation': ...}
+#
+# PUTs and DELETEs for the same instance run one after the other.  Each new
+# one bumps the generation, which tells a start still in progress that it is
+# no longer wanted so it stops early instead of holding everyone up.
+INSTANCE_OPS = {}
+INSTANCE_OPS_LOCK = threading.Lock()
+
+# FAKE_INSTANCES[<instance-name>] = (instance info, web server standing in for it)
+FAKE_INSTANCES = {}
+FAKE_LOCK = threading.Lock()
+
+
+@app.route('/')
+def root():
+    mode = 'fake' if FAKE_DOCKER else 'docker'
+    return f'<h1>I am Alive ({mode})</h1>'
+
+
+def runCmd(tokens):
+    # tokens are passed straight to the program (no shell), so values coming
+    # from the catalog cannot inject commands
+    print('running: ', ' '.join(tokens))
+    try:
+        result = subprocess.run(tokens, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except: # catch *all* exceptions
+        e = str(sys.exc_info()[0])
+        msg = 'Error running cmd: ' + ' '.join(tokens) + ', ' + e
+        print(msg)
+        return 1, msg
+
+    output = result.stdout.decode('utf8')
+    print('output:', output)
+    sys.stdout.flush()
+    return result.returncode, output
+
+
+def waitForTcp(address, port, timeoutSeconds, isSuperseded=lambda: False):
+    deadline = time.time() + timeoutSeconds
+    while time.time() < deadline and not isSuperseded():
+        try:
+            with socket.create_connection((address, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(PROBE_INTERVAL_SECONDS)
+    return False
+
+
+def beginInstanceOp(name):
+    with INSTANCE_OPS_LOCK:
+        op = INSTANCE_OPS.setdefault(name, {'lock': threading.Lock(), 'generation': 0})
+        op['generation'] += 1
+        generation = op['generation']
+    return op, lambda: op['generation'] != generation
+
+
+def orderByDependencies(containers):
+    # dependencies first, the same way Cloud Run honours container-dependencies
+    byName = {container['name']: container for container in containers}
+    ordered = []
+    visiting = set()
+
+    def visit(container):
+        if container in ordered:
+            return
+        if container['name'] in visiting:
+            raise ValueError('circular container dependency: ' + container['name'])
+        visiting.add(container['name'])
+        for dependency in container['dependsOn']:
+            if dependency not in byName:
+                raise ValueError(f"{container['name']} depends on unknown container {dependency}")
+            visit(byName[dependency])
+        ordered.append(container)
+
+    for container in containers:
+        visit(container)
+    return ordered
+
+
+# ---------------------------------------------------------------------------
+# docker
+
+# a container that is restarting after a crash ('--restart on-failure') still counts
+LIVE_CONTAINER_STATES = ['running', 'restarting']
+
+def listDockerInstances():
+    # Exited containers are listed too: an instance is only 'running' while
+    # all of its containers are.  One whose pause container is gone (e.g.
+    # after a host reboot) is dead even though its leftovers are still here.
+    fields = [LABEL_INSTANCE, LABEL_START_TIME, LABEL_PUBLISHED_PORT, LABEL_CPU, LABEL_MEMORY]
+    format = '{{.State}} ' + ' '.join('{{.Label "' + field + '"}}' for field in fields)
+    returnCode, output = runCmd(['docker', 'ps', '-a', '--filter', 'label=' + LABEL_INSTANCE, '--format', format])
+    if returnCode != 0:
+        raise RuntimeError(output)
+
+    instances = {}
+    for line in output.splitlines():
+        tokens = line.split()
+        if len(tokens) != len(fields) + 1:
+            continue
+        state, name, startTime, publishedPort, cpu, memory = tokens
+        if name not in instances:
+            instances[name] = {"name": name, "startTime": int(startTime), "publishedPort": int(publishedPort), "cpu": int(cpu), "memory": int(memory), "running": True}
+        if state not in LIVE_CONTAINER_STATES:
+            instances[name]['running'] = False
+    return list(instances.values())
+
+
+def removeDockerInstance(name):
+    returnCode, output = runCmd(['docker', 'ps', '-aq', '--filter', f'label={LABEL_INSTANCE}={name}'])
+    containerIds = output.split() if returnCode == 0 else []
+    if containerIds:
+        runCmd(['docker', 'rm', '-f'] + containerIds)
+
+
+def getContainerAddress(containerName):
+    returnCode, output = runCmd(['docker', 'inspect', '-f', '{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}', containerName])
+    return output.strip() if returnCode == 0 else None
+
+
+def startDockerInstance(name, spec, isSuperseded):
+    # On Cloud Run all containers of an instance share one network namespace,
+    # so they reach each other on localhost (e.g. the order-up app connects to
+    # its db on localhost:5432).  Same here: a pause container owns the
+    # namespace and the published port, every other container joins it.
+    deadline = time.time() + spec['startTimeoutSeconds']
+
+    labels = {
+        LABEL_INSTANCE: name,
+        LABEL_START_TIME: spec['startTime'],
+        LABEL_PUBLISHED_PORT: spec['publishedPort'],
+        LABEL_CPU: spec['cpu'],
+        LABEL_MEMORY: spec['memory'],
+    }
+
+    labelTokens = []
+    for key, value in labels.items():
+        labelTokens += ['--label', f'{key}={value}']
+
+    pauseName = f'{name}-pause'
+    if isSuperseded():
+        return 'superseded by a newer request'
+    tokens = ['docker', 'run', '-d',
+              '--name', pauseName,
+              '-p', f"{spec['publishedPort']}:{spec['containerPort']}"]
+    returnCode, output = runCmd(tokens + labelTokens + [PAUSE_IMAGE])
+    if returnCode != 0:
+        return 'failed to start pause container: ' + output
+
+    address = getContainerAddress(pauseName)
+    if not address:
+        return 'failed to find the address of ' + pauseName
+
+    for container in orderByDependencies(spec['containers']):
+        if isSuperseded():
+            return 'superseded by a newer request'
+        if time.time() > deadline:
+            return f"ran out of time before starting {container['name']}"
+
+        containerName = f"{name}-{container['name']}"
+        tokens = ['docker', 'run', '-d',
+                  '--name', containerName,
+                  '--network', 'container:' + pauseName,
+                  '--cpus', str(container['cpu'] / 1000),
+                  '--memory', f"{container['memory']}m",
+                  '--restart', 'on-failure']
+        tokens += labelTokens
+        for key, value in container['env'].items():
+            tokens += ['-e', f'{key}={value}']
+        tokens.append(container['image'])
+
+        returnCode, output = runCmd(tokens)
+        if returnCode != 0:
+            return f"failed to start {container['name']}: {output}"
+
+        # Probe the shared namespace directly rather than through the published
+        # port: docker's port proxy accepts connections before the app is listening.
+        if container['probePort']:
+            timeoutSeconds = min(container['probeBudgetSeconds'], deadline - time.time())
+            if not waitForTcp(address, container['probePort'], timeoutSeconds, isSuperseded):
+                return f"{container['name']} did not become ready on port {container['probePort']}"
+
+    return None
+
+
+# ---------------------------------------------------------------------------
+# fake docker
+
+class FakeInstanceHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = f'<h1>fake instance {self.server.instanceName}</h1>'.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def listFakeInstances():
+    with FAKE_LOCK:
+        return [info for info, server in FAKE_INSTANCES.values()]
+
+
+def removeFakeInstance(name):
+    with FAKE_LOCK:
+        entry = FAKE_INSTANCES.pop(name, None)
+    if entry:
+        info, server = entry
+        server.shutdown()
+        server.server_close()
+
+
+def startFakeInstance(name, spec):
+    deadline = time.time() + spec['startTimeoutSeconds']
+
+    for container in orderByDependencies(spec['containers']):
+        print('fake start: ', name, container['name'])
+        if container['name'] != spec['ingressContainer']:
+            continue
+
+        try:
+            server = http.server.ThreadingHTTPServer(('0.0.0.0', spec['publishedPort']), FakeInstanceHandler)
+        except OSError as e:
+            return f"cannot listen on port {spec['publishedPort']}: {e}"
+        server.instanceName = name
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        info = {"name": name, "startTime": spec['startTime'], "publishedPort": spec['publishedPort'], "cpu": spec['cpu'], "memory": spec['memory'], "running": True}
+        with FAKE_LOCK:
+            FAKE_INSTANCES[name] = (info, server)
+
+        # through the published port, it stands in for the ingress container's probe port
+        timeoutSeconds = min(container['probeBudgetSeconds'], deadline - time.time())
+        if not waitForTcp('127.0.0.1', spec['publishedPort'], timeoutSeconds):
+            return f"{container['name']} did not become ready on port {spec['publishedPort']}"
+
+    return None
+
+
+# ---------------------------------------------------------------------------
+# routes
+
+def isValidSpec(spec):
+    if not isinstance(spec, dict) or not isinstance(spec.get('containers'), list):
+        return False
+    for container in spec['containers']:
+        if not re.match(NO_INJECTION_REGEX, str(container.get('name'))):
+            return False
+    return True
+
+
+@app.route('/instances')
+def listInstances():
+    try:
+        if FAKE_DOCKER:
+            return listFakeInstances()
+        return listDockerInstances()
+    except RuntimeError as e:
+        return {"message": "failed to list instances: " + str(e)}, 500
+
+
+@app.route('/instances/<name>', methods = ['PUT'])
+def startInstance(name):
+    if not name.startswith('dyn-svc-') or not re.match(NO_INJECTION_REGEX, name):
+        return {"message": "invalid instance name"}, 400
+
+    spec = request.get_json(silent=True)
+    if not isValidSpec(spec):
+        return {"message": "invalid instance spec"}, 400
+
+    op, isSuperseded = beginInstanceOp(name)
+    with op['lock']:
+        # Same as Cloud Run's 'replace': whatever ran under this name is gone.
+        try:
+            if FAKE_DOCKER:
+                removeFakeInstance(name)
+                error = startFakeInstance(name, spec)
+            else:
+                removeDockerInstance(name)
+                error = startDockerInstance(name, spec, isSuperseded)
+        except Exception as e:
+            # e.g. a bad container-dependencies entry.  Whatever got started
+            # must still go, the service manager counts on it.
+            error = f'{type(e).__name__}: {e}'
+
+        if error:
+            print('start failed: ', name, error)
+            if FAKE_DOCKER:
+                removeFakeInstance(name)
+            else:
+                removeDockerInstance(name)
+            return {"message": error}, 500
+
+    return {"message": "instance started"}, 200
+
+
+@app.route('/instances/<name>', methods = ['DELETE'])
+def deleteInstance(name):
+    if not name.startswith('dyn-svc-') or not re.match(NO_INJECTION_REGEX, name):
+        return {"message": "invalid instance name"}, 400
+
+    op, isSuperseded = beginInstanceOp(name)
+    with op['lock']:
+        if FAKE_DOCKER:
+            removeFakeInstance(name)
+        else:
+            removeDockerInstance(name)
+    return {"message": "instance removed"}, 200
+
+
+print('agent ready, fake docker:', FAKE_DOCKER)
+
+if __name__ == "__main__":
+    app.run(host='0.0.0.0', port=int(os.environ.get('AGENT_PORT', '7000')), threaded=True)
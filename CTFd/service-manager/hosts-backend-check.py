@@ -0,0 +1,197 @@
+# Exercises the "hosts" backend (app/hostpool.py) against two fake host agents
+# (host-agent/agent.py with FAKE_DOCKER=1), no docker or gcloud needed:
+#
+#   pip3 install -r app/requirements.txt -r host-agent/requirements.txt
+#   python3 hosts-backend-check.py
+#
+# Stops at the first check that fails.
+
+import json
+import os
+import requests
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'app'))
+
+os.environ['AGENT_PASSWORD'] = 'checkstuff'
+
+import hostpool
+
+AGENTS = [
+    # name, agent port, cpu, memory, ports
+    ('small', 7101, 4000, 4096, [20100, 20109]),
+    ('big', 7102, 8000, 8192, [20200, 20209]),
+]
+
+
+def check(description, condition):
+    print('ok  ' if condition else 'FAIL', description)
+    if not condition:
+        sys.exit(1)
+
+
+def startAgents():
+    processes = []
+    for name, port, cpu, memory, ports in AGENTS:
+        env = dict(os.environ, FAKE_DOCKER='1', AGENT_PORT=str(port))
+        processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, 'host-agent', 'agent.py')], env=env,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    for name, port, cpu, memory, ports in AGENTS:
+        for attempt in range(50):
+            try:
+                requests.get(f'http://localhost:{port}/', timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+    return processes
+
+
+def writeHostsFile():
+    hosts = [{"name": name, "agentUrl": f"http://localhost:{port}", "publicHost": "localhost",
+              "cpu": cpu, "memory": memory, "ports": ports}
+             for name, port, cpu, memory, ports in AGENTS]
+    f = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(hosts, f)
+    f.close()
+    return f.name
+
+
+def agentInstances(hostName):
+    host = getHost(hostName)
+    return sorted(item['name'] for item in hostpool.callAgent(host, 'GET', '/instances').json())
+
+
+def getHost(hostName):
+    return [host for host in hostpool.HOSTS if host['name'] == hostName][0]
+
+
+def checkParsing():
+    check('parseCpu 1000m', hostpool.parseCpu('1000m') == 1000)
+    check('parseCpu 0.5', hostpool.parseCpu('0.5') == 500)
+    check('parseCpu 2', hostpool.parseCpu(2) == 2000)
+    check('parseMemory 512Mi', hostpool.parseMemory('512Mi') == 512)
+    check('parseMemory 1Gi', hostpool.parseMemory('1Gi') == 1024)
+    check('parseMemory 1G', hostpool.parseMemory('1G') == 953)
+    check('parseMemory bytes', hostpool.parseMemory(str(256 * 1024 * 1024)) == 256)
+
+
+def checkBadDependencies():
+    with open(os.path.join(HERE, 'app', 'order-up-gcloud-service.yaml')) as f:
+        data = f.read()
+
+    for dependencies, expected in [('{"order-up-app":["nope"]}', 'unknown container'),
+                                   ('{"order-up-app":["order-up-db"],"order-up-db":["order-up-app"]}', 'circular')]:
+        badData = data.replace('{"order-up-app":["order-up-db"]}', dependencies)
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+            f.write(badData)
+        try:
+            hostpool.loadServiceSpec(f.name)
+            rejected = False
+        except ValueError as e:
+            rejected = expected in str(e)
+        os.unlink(f.name)
+        check('catalog rejected: ' + expected + ' dependency', rejected)
+
+
+def checkBestFit():
+    def makeHost(name, usedCpu, usedMemory, usedPorts=()):
+        return {'name': name, 'cpu': 16000, 'memory': 65536, 'usedCpu': usedCpu, 'usedMemory': usedMemory,
+                'firstPort': 1, 'lastPort': 2, 'usedPorts': set(usedPorts), 'healthy': True}
+
+    spec = {'cpu': 2000, 'memory': 1024}
+    realHosts = hostpool.HOSTS[:]
+    try:
+        hostpool.HOSTS[:] = [makeHost('empty', 0, 0), makeHost('busy', 12000, 40000), makeHost('full', 15500, 0)]
+        check('best fit picks the busiest host that fits', hostpool.pickHost(spec)['name'] == 'busy')
+
+        hostpool.HOSTS[:] = [makeHost('empty', 0, 0), makeHost('busy', 12000, 40000, [1, 2])]
+        check('host without free ports is skipped', hostpool.pickHost(spec)['name'] == 'empty')
+
+        hostpool.HOSTS[:] = [makeHost('adopted', 0, 0, [1, 99]), makeHost('other', 0, 0)]
+        hostpool.HOSTS[0]['lastPort'] = 1
+        check('adopted ports outside the range do not count as free', hostpool.pickHost(spec)['name'] == 'other')
+    finally:
+        hostpool.HOSTS[:] = realHosts
+
+
+def forgetEverything():
+    # what a restarted service manager knows
+    with hostpool.LOCK:
+        hostpool.INSTANCES.clear()
+        for host in hostpool.HOSTS:
+            host['usedCpu'] = 0
+            host['usedMemory'] = 0
+            host['usedPorts'] = set()
+            host['healthy'] = False
+
+
+def checkAgainstFakeAgents():
+    instance, error = hostpool.startServiceInstance('order-up', 'dyn-svc-order-up-aaa')
+    check('no instances before the hosts are reconciled', instance is None)
+
+    hostpool.pruneOldDynamicServices()
+    check('hosts are healthy after the first prune', all(host['healthy'] for host in hostpool.HOSTS))
+
+    startTime = time.time()
+    instance, error = hostpool.startServiceInstance('order-up', 'dyn-svc-order-up-aaa')
+    check('instance started' + (': ' + error if error else ''), instance is not None)
+    check('instance started in under a second', time.time() - startTime < 1)
+    check('best fit places it on the small host', instance['host']['name'] == 'small')
+    check('instance url answers', 'dyn-svc-order-up-aaa' in requests.get(hostpool.getServiceUrl(instance), timeout=5).text)
+
+    serviceUrl, secondsToLive = hostpool.findServiceInstance('dyn-svc-order-up-aaa')
+    check('instance is found', serviceUrl == hostpool.getServiceUrl(instance) and secondsToLive > 3500)
+
+    for uniqueChalId in ['bbb', 'ccc', 'ddd', 'eee', 'fff']:
+        hostpool.startServiceInstance('order-up', 'dyn-svc-order-up-' + uniqueChalId)
+    check('pool holds 6 order-up instances', len(hostpool.INSTANCES) == 6)
+    instance, error = hostpool.startServiceInstance('order-up', 'dyn-svc-order-up-ggg')
+    check('the 7th one is turned away', instance is None and 'room' in error)
+
+    instance, error = hostpool.startServiceInstance('order-up', 'dyn-svc-order-up-aaa')
+    check('starting again replaces the instance', instance is not None and len(hostpool.INSTANCES) == 6)
+    check('the agents run exactly what the manager knows',
+          agentInstances('small') + agentInstances('big') == sorted(hostpool.INSTANCES))
+
+    forgetEverything()
+    hostpool.pruneOldDynamicServices()
+    check('a restarted manager adopts the running instances', len(hostpool.INSTANCES) == 6)
+    check('adopted instances take up their room again', getHost('big')['usedCpu'] == 8000)
+
+    droppedHost = hostpool.INSTANCES['dyn-svc-order-up-bbb']['host']
+    hostpool.callAgent(droppedHost, 'DELETE', '/instances/dyn-svc-order-up-bbb')
+    hostpool.pruneOldDynamicServices()
+    check('an instance gone from its host is dropped', 'dyn-svc-order-up-bbb' not in hostpool.INSTANCES)
+
+    # leave a stale copy of an instance on the other host
+    instance = hostpool.INSTANCES['dyn-svc-order-up-ccc']
+    otherHost = getHost('big' if instance['host']['name'] == 'small' else 'small')
+    spec = dict(hostpool.SERVICE_SPECS['order-up'], startTime=int(time.time()), publishedPort=otherHost['lastPort'])
+    hostpool.callAgent(otherHost, 'PUT', '/instances/dyn-svc-order-up-ccc', spec, timeout=30)
+    hostpool.pruneOldDynamicServices()
+    check('a stale copy on another host is undeployed', 'dyn-svc-order-up-ccc' not in agentInstances(otherHost['name']))
+    check('the real copy is kept', hostpool.INSTANCES['dyn-svc-order-up-ccc'] is instance)
+
+    hostpool.MAX_LIFETIME_SECONDS = 0
+    hostpool.pruneOldDynamicServices()
+    check('expired instances are pruned', not hostpool.INSTANCES)
+    check('the agents run nothing any more', agentInstances('small') + agentInstances('big') == [])
+    check('all room is given back', all(host['usedCpu'] == 0 and not host['usedPorts'] for host in hostpool.HOSTS))
+
+
+processes = startAgents()
+try:
+    hostpool.setup(writeHostsFile(), {'order-up': 'order-up-gcloud-service.yaml'}, os.path.join(HERE, 'app'), 60*60)
+    checkParsing()
+    checkBadDependencies()
+    checkBestFit()
+    checkAgainstFakeAgents()
+    print('all checks passed')
+finally:
+    for process in processes:
+        process.terminate()